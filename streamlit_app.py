@@ -2,25 +2,45 @@ import streamlit as st
 import os
 import struct
 import fitz  # PyMuPDF
-from PIL import Image, ImageEnhance, ImageDraw, ImageFont, ImageOps, ImageFilter
+import numpy as np
+from PIL import Image, ImageEnhance, ImageDraw, ImageFont, ImageOps, ImageFilter, ImageStat
 import ebooklib
 from ebooklib import epub
-from bs4 import BeautifulSoup, NavigableString
+from bs4 import BeautifulSoup, NavigableString, SoupStrainer
 import pyphen
 import base64
 import re
 import tempfile
+import shutil
 import io
 import json
+import hashlib
+import html
 import zipfile
-import shutil
 from urllib.parse import unquote
 import concurrent.futures
+import functools
+import itertools
+import bisect
+import math
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
 
 # --- CONFIGURATION DEFAULTS ---
 DEFAULT_SCREEN_WIDTH = 480
 DEFAULT_SCREEN_HEIGHT = 800
-DEFAULT_RENDER_SCALE = 3.0
+PREVIEW_PAGE_CACHE_SIZE = 32
+MAX_FONT_FILE_SIZE = 32 * 1024 * 1024
+# Extracted font ZIPs kept on disk at once; older ones are deleted when they drop out of the cache
+MAX_CACHED_FONT_DIRS = 4
+# Preparing a chapter body (footnotes, hyphenation) costs far more per byte than laying it out
+PARALLEL_PREPARE_MIN_BYTES = 256 * 1024
+# Indexing note ids parses each document once; below this much XHTML a process pool costs more than it saves
+PARALLEL_ID_MAP_MIN_BYTES = 1024 * 1024
+MAX_PARALLEL_WORKERS = 4
 DEFAULT_FONT_SIZE = 28
 DEFAULT_MARGIN = 20
 DEFAULT_LINE_HEIGHT = 1.4
@@ -35,6 +55,35 @@ DEFAULT_TEXT_BLUR = 1.0
 DEFAULT_WHITE_CLIP = 220
 DEFAULT_CONTRAST = 1.2
 
+# --- XTC FORMAT ---
+XTC_HEADER = struct.Struct("<IHHBBBBIQQQQQ")
+XTC_INDEX_ENTRY = struct.Struct("<QIHH")
+XTG_HEADER = struct.Struct("<IHHBBIQ")
+
+# --- PARSING ---
+try:
+    import lxml  # noqa: F401  (C parser, roughly 10x faster than html.parser)
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+CSS_FONT_FAMILY_RE = re.compile(r'font-family\s*:\s*[^;!]+')
+WORD_RE = re.compile(r'\w{6,}', re.UNICODE)
+BACKLINK_NUM_RE = re.compile(r'^[\s\[\(]*\d+[\.\)\]]*$')
+FOOTNOTE_NUM_RE = re.compile(r'^[\(\[]?\d+[\)\]]?$')
+FOOTNOTE_ROMAN_RE = re.compile(r'^[\(\[]?[ivx]+[\)\]]?$')
+BACKLINK_ROLES = frozenset(['doc-backlink', 'doc-noteref'])
+BACKLINK_MARKERS = ('↑', 'site', 'back', 'return', '↩')
+HEADING_TAGS = ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']
+CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.DOTALL)
+# Quoted strings and url(...) are matched first and kept, so comments and whitespace are only touched outside them
+CSS_MINIFY_RE = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|url\([^)"\']*\))|(?:\s|/\*.*?\*/)+', re.DOTALL)
+IMG_SRC_RE = re.compile(r'(<img\s[^>]*?(?<![\w-])src=)(["\'])(.*?)\2')
+# Book and reader CSS stay in separate style elements so a broken book rule can't swallow the reader rules
+CHAPTER_HTML_TEMPLATE = ("<html lang='{lang}'><head><style>{book_css}</style><style>{reader_css}</style></head>"
+                         "<body>{body}</body></html>")
+FOOTNOTE_CONTAINER_CLASSES = frozenset(['footnote', 'endnote', 'reflist', 'bibliography'])
+FOOTNOTE_LINK_CLASS_MARKERS = ('footnote', 'noteref', 'ref')
+
 # --- SYSTEM FONTS (FITZ / BASE-14) ---
 FITZ_FONTS = {
     "--- SERIF (Book Standard) ---": "Times-Roman",
@@ -52,6 +101,22 @@ FITZ_FONTS = {
     "Mono: Courier Bold": "Courier-Bold",
     "Mono: Generic": "monospace",
 }
+# (font_data key, CSS font-weight, CSS font-style) for uploaded font sets
+FONT_FACE_VARIANTS = (("regular", "normal", "normal"), ("bold", "bold", "normal"),
+                      ("italic", "normal", "italic"), ("bold_italic", "bold", "italic"))
+FONT_BOLD_MARKERS = ("bold", "bd", "-b", "_b")
+FONT_ITALIC_MARKERS = ("italic", "oblique", "obl", "-i", "_i")
+GENERIC_FONT_FAMILIES = frozenset(["serif", "sans-serif", "monospace", "cursive", "fantasy"])
+
+
+# --- UI OPTIONS ---
+ELEMENT_POSITIONS = ["Header", "Footer", "Hidden"]
+PROGRESS_POSITIONS = ["Footer (Below Text)", "Footer (Above Text)", "Header (Below Text)", "Header (Above Text)",
+                      "Hidden"]
+ALIGN_OPTIONS = ["Center", "Left", "Right", "Justify"]
+ELEMENT_POSITION_INDEX = {opt: i for i, opt in enumerate(ELEMENT_POSITIONS)}
+PROGRESS_POSITION_INDEX = {opt: i for i, opt in enumerate(PROGRESS_POSITIONS)}
+ALIGN_INDEX = {opt: i for i, opt in enumerate(ALIGN_OPTIONS)}
 
 
 # --- UTILITY FUNCTIONS ---
@@ -59,26 +124,59 @@ FITZ_FONTS = {
 def fix_css_font_paths(css_text, target_font_family="'CustomFont'"):
     if target_font_family is None:
         return css_text
-    css_text = re.sub(r'font-family\s*:\s*[^;!]+', f'font-family: {target_font_family}', css_text)
+    css_text = CSS_FONT_FAMILY_RE.sub(f'font-family: {target_font_family}', css_text)
     return css_text
 
 
+def clamp(value, lo, hi):
+    return lo if value < lo else hi if value > hi else value
+
+
+def _minify_css_token(match):
+    if match.group(1): return match.group(1)
+    return ' ' if CSS_COMMENT_RE.sub('', match.group(0)) else ''
+
+
+def minify_css(css_text):
+    return CSS_MINIFY_RE.sub(_minify_css_token, css_text).strip()
+
+
+def pack_bits(mask_u8_2d):
+    """Packs a 2D white/black mask into XTG rows (MSB first, 1 = white)."""
+    return np.packbits(mask_u8_2d, axis=1, bitorder='big').tobytes()
+
+
+@functools.lru_cache(maxsize=None)
+def threshold_lut(threshold, below=None):
+    """Lookup table for Image.point: above threshold -> white, else `below` (unchanged when None)."""
+    return tuple(255 if p > threshold else (p if below is None else below) for p in range(256))
+
+
+@functools.lru_cache(maxsize=64)
+def tone_lut(mean, contrast, white_clip):
+    """Contrast (ImageEnhance.Contrast's blend around the page mean) and white clipping as one Image.point table."""
+    ramp = Image.frombytes("L", (256, 1), bytes(range(256)))
+    if contrast != 1.0: ramp = Image.blend(Image.new("L", (256, 1), mean), ramp, contrast)
+    return tuple(ramp.point(threshold_lut(white_clip)).getdata())
+
+
 def get_font_variants(directory):
-    all_files_paths = []
+    # Lower-cased file names are kept next to their paths so each name is normalised once
+    font_files = []
     for root, dirs, files in os.walk(directory):
         for f in files:
-            if f.lower().endswith((".ttf", ".otf")):
-                all_files_paths.append(os.path.join(root, f).replace("\\", "/"))
+            name_lower = f.lower()
+            if name_lower.endswith((".ttf", ".otf")):
+                font_files.append((os.path.join(root, f).replace("\\", "/"), name_lower))
 
-    if not all_files_paths:
+    if not font_files:
         return {}
 
     candidates = {"regular": [], "italic": [], "bold": [], "bold_italic": []}
 
-    for full_path in all_files_paths:
-        name_lower = os.path.basename(full_path).lower()
-        has_bold = any(x in name_lower for x in ["bold", "bd", "-b", "_b"])
-        has_italic = any(x in name_lower for x in ["italic", "oblique", "obl", "-i", "_i"])
+    for full_path, name_lower in font_files:
+        has_bold = any(x in name_lower for x in FONT_BOLD_MARKERS)
+        has_italic = any(x in name_lower for x in FONT_ITALIC_MARKERS)
 
         if has_bold and has_italic:
             candidates["bold_italic"].append(full_path)
@@ -91,7 +189,7 @@ def get_font_variants(directory):
 
     def pick_best(file_list):
         if not file_list: return None
-        return sorted(file_list, key=len)[0]
+        return min(file_list, key=len)
 
     results = {
         "regular": pick_best(candidates["regular"]),
@@ -100,12 +198,30 @@ def get_font_variants(directory):
         "bold_italic": pick_best(candidates["bold_italic"])
     }
 
-    if not results["regular"] and all_files_paths:
-        results["regular"] = all_files_paths[0]
+    if not results["regular"]:
+        results["regular"] = font_files[0][0]
 
     return results
 
 
+def _remove_font_dir(loaded_font):
+    shutil.rmtree(loaded_font[0], ignore_errors=True)
+
+
+@st.cache_resource(show_spinner=False, max_entries=MAX_CACHED_FONT_DIRS, on_release=_remove_font_dir)
+def _load_custom_font(sig, _data):
+    """Extracts an uploaded font ZIP once per content hash; returns its directory and scanned variants."""
+    font_dir = os.path.join(tempfile.gettempdir(), f"epub_xtc_fonts_{sig}")
+    os.makedirs(font_dir, exist_ok=True)
+    with zipfile.ZipFile(io.BytesIO(_data)) as z:
+        # Only font files are needed; ZipFile.extract streams each member to disk
+        for info in z.infolist():
+            if info.is_dir() or info.file_size > MAX_FONT_FILE_SIZE: continue
+            if info.filename.lower().endswith((".ttf", ".otf")): z.extract(info, font_dir)
+    return font_dir, get_font_variants(font_dir)
+
+
+@functools.lru_cache(maxsize=64)
 def get_pil_font(font_identifier, size):
     if font_identifier and os.path.exists(font_identifier):
         try:
@@ -139,28 +255,37 @@ def get_pil_font(font_identifier, size):
     return ImageFont.load_default()
 
 
+def truncate_to_width(font, text, max_width, suffix="..."):
+    # Binary search for the longest prefix that still fits with the suffix appended
+    n = bisect.bisect_right(range(len(text)), max_width, key=lambda k: font.getlength(text[:k] + suffix)) - 1
+    return text[:n] + suffix if n > 0 else ""
+
+
 def extract_all_css(book):
     css_rules = []
     for item in book.get_items_of_type(ebooklib.ITEM_STYLE):
         try:
-            css_rules.append(item.get_content().decode('utf-8', errors='ignore'))
+            css_rules.append(item.get_content())
         except:
             pass
-    return "\n".join(css_rules)
+    # Join the raw sheets and decode once
+    return b"\n".join(css_rules).decode('utf-8', errors='ignore')
 
 
-def extract_images_to_base64(book):
+def extract_images(book):
     image_map = {}
     for item in book.get_items_of_type(ebooklib.ITEM_IMAGE):
         try:
-            filename = os.path.basename(item.get_name())
-            b64_data = base64.b64encode(item.get_content()).decode('utf-8')
-            image_map[filename] = f"data:{item.media_type};base64,{b64_data}"
+            image_map[os.path.basename(item.get_name())] = (item.media_type, item.get_content())
         except:
             pass
     return image_map
 
 
+def image_to_data_uri(media_type, raw_bytes):
+    return f"data:{media_type};base64,{base64.b64encode(raw_bytes).decode('ascii')}"
+
+
 def get_official_toc_mapping(book):
     mapping = {}
 
@@ -189,7 +314,7 @@ def get_official_toc_mapping(book):
                          if item.get_type() == ebooklib.ITEM_NAVIGATION), None)
         if nav_item:
             try:
-                soup = BeautifulSoup(nav_item.get_content(), 'html.parser')
+                soup = BeautifulSoup(nav_item.get_content(), HTML_PARSER, parse_only=SoupStrainer('nav'))
                 nav_element = soup.find('nav', attrs={'epub:type': 'toc'}) or soup.find('nav')
                 if nav_element:
                     for link in nav_element.find_all('a', href=True):
@@ -199,32 +324,112 @@ def get_official_toc_mapping(book):
     return mapping
 
 
-def hyphenate_html_text(soup, language_code):
+@functools.lru_cache(maxsize=8)
+def _get_pyphen(language_code):
     try:
-        dic = pyphen.Pyphen(lang=language_code)
+        return pyphen.Pyphen(lang=language_code)
     except:
         try:
-            dic = pyphen.Pyphen(lang='en')
+            return pyphen.Pyphen(lang='en')
         except:
-            return soup
-    word_pattern = re.compile(r'\w+', re.UNICODE)
-    for text_node in soup.find_all(string=True):
-        if text_node.parent.name in ['script', 'style', 'head', 'title', 'meta']: continue
+            return None
+
+
+@functools.lru_cache(maxsize=200_000)
+def _hyphenate_word(language_code, word):
+    return _get_pyphen(language_code).inserted(word, hyphen='\u00AD')
+
+
+_HYPHEN_SKIP_PARENTS = frozenset(['script', 'style', 'head', 'title', 'meta'])
+
+
+def hyphenate_html_text(soup, language_code):
+    if _get_pyphen(language_code) is None:
+        return soup
+    replacements = []
+    for text_node in soup.descendants:
+        if not isinstance(text_node, NavigableString): continue
+        if text_node.parent.name in _HYPHEN_SKIP_PARENTS: continue
         if not text_node.strip(): continue
         original_text = str(text_node)
+        if '\u00A0' not in original_text and not WORD_RE.search(original_text): continue
         clean_text = original_text.replace('\u00A0', ' ')
 
-        def replace_match(match):
-            word = match.group(0)
-            if len(word) < 6: return word
-            return dic.inserted(word, hyphen='\u00AD')
+        parts = []
+        last_end = 0
+        for match in WORD_RE.finditer(clean_text):
+            parts.append(clean_text[last_end:match.start()])
+            parts.append(_hyphenate_word(language_code, match.group(0)))
+            last_end = match.end()
+        parts.append(clean_text[last_end:])
 
-        new_text = word_pattern.sub(replace_match, clean_text)
+        new_text = "".join(parts)
         if new_text != original_text:
-            text_node.replace_with(NavigableString(new_text))
+            replacements.append((text_node, new_text))
+    # Swap nodes after the walk so the descendants generator is not invalidated
+    for text_node, new_text in replacements:
+        text_node.replace_with(NavigableString(new_text))
     return soup
 
 
+_NOTE_ROOT_TAGS = frozenset(['body', 'html', 'section'])
+_NOTE_BLOCK_TAGS = frozenset(['aside', 'li', 'dd', 'div'])
+
+
+def _smart_extract_content(elem):
+    if elem.name == 'a':
+        parent = elem.parent
+        if parent and parent.name not in _NOTE_ROOT_TAGS: return parent
+        return elem
+    if elem.name in _NOTE_BLOCK_TAGS: return elem
+    text = elem.get_text(strip=True)
+    if len(text) > 1: return elem
+    parent = elem.parent
+    if parent:
+        if parent.name in _NOTE_ROOT_TAGS: return elem
+        return parent
+    return elem
+
+
+def _is_scrubbed_link(a):
+    if a.get('role') in BACKLINK_ROLES: return True
+    text = a.get_text(strip=True)
+    if any(x in text for x in BACKLINK_MARKERS): return True
+    return bool(len(text) < 5 and BACKLINK_NUM_RE.match(text))
+
+
+def _parallel_workers():
+    """CPUs this process may run on (containers often pin fewer than cpu_count), capped for the pools."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    return min(cpus, MAX_PARALLEL_WORKERS)
+
+
+def _extract_document_ids(filename, content):
+    id_map = {}
+    try:
+        soup = BeautifulSoup(content, HTML_PARSER)
+        for elem in soup.find_all(id=True):
+            target_node = _smart_extract_content(elem)
+            # Detach back-links in place while serializing instead of copying the subtree
+            removed = []
+            for a in target_node.find_all('a'):
+                if _is_scrubbed_link(a):
+                    placeholder = NavigableString("")
+                    a.replace_with(placeholder)
+                    removed.append((a, placeholder))
+            final_html = target_node.decode_contents().strip()
+            for a, placeholder in reversed(removed):
+                placeholder.replace_with(a)
+            if not final_html and removed: final_html = target_node.decode_contents().strip()
+            if final_html: id_map[f"{filename}#{elem['id']}"] = final_html
+    except Exception:
+        pass
+    return id_map
+
+
 # --- PROCESSING ENGINE ---
 
 class EpubProcessor:
@@ -232,88 +437,82 @@ class EpubProcessor:
         self.raw_chapters = []
         self.book_css = ""
         self.book_images = {}
+        self.book_image_uris = {}
         self.book_lang = 'en'
         self.is_parsed = False
         self.cover_image_obj = None
+        self.cover_image_bytes = None
         self.global_id_map = {}
+        # Worker process pools are opt-in: forking the multi-threaded Streamlit server is not always safe
+        self.use_processes = False
+        self.notes_have_images = False
+        self._body_cache = {}
         self.fitz_docs = []
+        self._doc_lock = threading.Lock()
+        self.epub_digest = None
+        self.chapter_sources = []
         self.toc_data_final = []
         self.toc_pages_images = []
         self.page_map = []
         self.total_pages = 0
         self.toc_items_per_page = 18
         self.is_ready = False
-        self.temp_dir = tempfile.TemporaryDirectory()
         self.layout_settings = {}
         self.font_data = {}
         self.ui_font_ref = None
-
-    def _smart_extract_content(self, elem):
-        if elem.name == 'a':
-            parent = elem.parent
-            if parent and parent.name not in ['body', 'html', 'section']: return parent
-            return elem
-        if elem.name in ['aside', 'li', 'dd', 'div']: return elem
-        text = elem.get_text(strip=True)
-        if len(text) > 1: return elem
-        parent = elem.parent
-        if parent:
-            if parent.name in ['body', 'html', 'section']: return elem
-            return parent
-        return elem
+        self._bar_strips = {}
+        self._page_text_cache = {}
+        self._toc_starts = None
+        self._page_cache = OrderedDict()
+        self._preview_cache = OrderedDict()
+        self._toc_cache_key = None
+        self._font_face_key = None
+        self._font_face_block = ""
+        self._toc_cache_pages = []
 
     def _build_global_id_map(self, book):
+        documents = [(os.path.basename(item.get_name()), item.get_content())
+                     for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT)]
         id_map = {}
-        for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
+        workers = min(_parallel_workers(), len(documents)) if self.use_processes else 1
+        if workers > 1 and sum(len(content) for _, content in documents) >= PARALLEL_ID_MAP_MIN_BYTES:
             try:
-                soup = BeautifulSoup(item.get_content(), 'html.parser')
-                filename = os.path.basename(item.get_name())
-                for elem in soup.find_all(id=True):
-                    target_node = self._smart_extract_content(elem)
-                    import copy
-                    content_node = copy.copy(target_node)
-                    original_raw_html = content_node.decode_contents().strip()
-                    for a in content_node.find_all('a'):
-                        if a.get('role') in ['doc-backlink', 'doc-noteref']:
-                            a.decompose()
-                            continue
-                        text = a.get_text(strip=True)
-                        if any(x in text for x in ['↑', 'site', 'back', 'return', '↩']):
-                            a.decompose()
-                            continue
-                        if len(text) < 5 and re.match(r'^[\s\[\(]*\d+[\.\)\]]*$', text):
-                            a.decompose()
-                            continue
-                    final_html = content_node.decode_contents().strip()
-                    if not final_html and original_raw_html: final_html = original_raw_html
-                    if final_html: id_map[f"{filename}#{elem['id']}"] = final_html
+                with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                    for doc_map in executor.map(_extract_document_ids, *zip(*documents)):
+                        id_map.update(doc_map)
+                return id_map
             except Exception:
-                pass
+                # No usable process pool (e.g. restricted host); fall back to in-process parsing
+                logger.warning("Note id pool failed, indexing notes in-process", exc_info=True)
+                id_map = {}
+        for filename, content in documents:
+            id_map.update(_extract_document_ids(filename, content))
         return id_map
 
     def _inject_inline_footnotes(self, soup, current_filename):
         if not self.global_id_map: return soup
         links = soup.find_all('a', href=True)
+        # Links inside note containers, collected once instead of walking every link's parents
+        in_note_container = set()
+        for container in soup.find_all(class_=True):
+            if FOOTNOTE_CONTAINER_CLASSES.isdisjoint(c.lower() for c in container.get('class', [])): continue
+            in_note_container.update(id(a) for a in container.find_all('a', href=True))
         for link in reversed(list(links)):
             raw_href = link['href']
             href = unquote(raw_href)
             text = link.get_text(strip=True)
             if not text and not link.find('sup'): continue
-            parent_classes = []
-            for parent in link.parents:
-                if parent.get('class'): parent_classes.extend(parent.get('class'))
-            if any(x in [c.lower() for c in parent_classes] for x in
-                   ['footnote', 'endnote', 'reflist', 'bibliography']): continue
+            if id(link) in in_note_container: continue
             is_footnote = False
             if 'noteref' in link.get('epub:type', '') or link.get('role') == 'doc-noteref': is_footnote = True
             css = link.get('class', [])
             if isinstance(css, list): css = " ".join(css)
-            if any(x in css.lower() for x in ['footnote', 'noteref', 'ref']): is_footnote = True
+            if any(x in css.lower() for x in FOOTNOTE_LINK_CLASS_MARKERS): is_footnote = True
             if not is_footnote and text:
                 clean_t = text.strip()
-                if re.match(r'^[\(\[]?\d+[\)\]]?$', clean_t) or clean_t == '*':
+                if FOOTNOTE_NUM_RE.match(clean_t) or clean_t == '*':
                     is_footnote = True
-                elif re.match(r'^[\(\[]?[ivx]+[\)\]]?$', clean_t.lower()):
+                elif FOOTNOTE_ROMAN_RE.match(clean_t.lower()):
                     is_footnote = True
             if not is_footnote: continue
             content = None
@@ -338,8 +537,9 @@ class EpubProcessor:
                 header = soup.new_tag("strong")
                 header.string = f"{text}: "
                 note_box.append(header)
-                content_soup = BeautifulSoup(content, 'html.parser')
-                note_box.append(content_soup)
+                content_soup = BeautifulSoup(content, HTML_PARSER)
+                # lxml wraps fragments in <html><body>; only move the fragment itself
+                note_box.extend(list((content_soup.body or content_soup).contents))
                 parent_block = new_marker.find_parent(['p', 'div', 'li', 'h1', 'h2', 'blockquote'])
                 if parent_block:
                     parent_block.insert_after(note_box)
@@ -347,99 +547,131 @@ class EpubProcessor:
                     new_marker.insert_after(note_box)
         return soup
 
-    def _find_cover_image(self, book):
+    def _find_cover_bytes(self, book, id_to_item):
+        """Encoded cover image; decoded only by _load_structure, so the parse cache keeps the compact file."""
         try:
             cover_data = book.get_metadata('OPF', 'cover')
             if cover_data:
                 cover_id = cover_data[0][1]
-                item = book.get_item_with_id(cover_id)
-                if item: return Image.open(io.BytesIO(item.get_content()))
+                item = id_to_item.get(cover_id)
+                if item:
+                    content = item.get_content()
+                    Image.open(io.BytesIO(content))
+                    return content
         except:
             pass
         for item in book.get_items_of_type(ebooklib.ITEM_IMAGE):
-            if 'cover' in item.get_name().lower(): return Image.open(io.BytesIO(item.get_content()))
+            if 'cover' in item.get_name().lower(): return item.get_content()
         for item in book.get_items_of_type(ebooklib.ITEM_IMAGE):
-            return Image.open(io.BytesIO(item.get_content()))
+            return item.get_content()
         return None
 
     def _split_html_by_toc(self, soup, toc_entries):
-        chunks = []
-        if len(toc_entries) == 1 and not toc_entries[0][0]:
-            return [{'title': toc_entries[0][1], 'soup': soup}]
+        whole = lambda: [{'title': toc_entries[0][1], 'html': str(soup), 'has_image': bool(soup.find('img'))}]
+        if len(toc_entries) == 1 and not toc_entries[0][0]: return whole()
         split_points = []
         for anchor, title in toc_entries:
             target = None
             if anchor: target = soup.find(id=anchor)
             if target or not anchor: split_points.append({'node': target, 'title': title})
-        if not split_points: return [{'title': toc_entries[0][1], 'soup': soup}]
-        current_idx = 0
-        current_soup = BeautifulSoup("<body></body>", 'html.parser')
+        if not split_points: return whole()
+        # Identity chain (node + ancestors) per split point: "child is or contains the target" becomes a set lookup
+        split_chains = [{id(p['node'])} | {id(a) for a in p['node'].parents} if p['node'] else set()
+                        for p in split_points]
+        # Group the top-level nodes per chunk first, then serialize each group once (no per-chunk soup)
+        groups = [[]]
         body_children = list(soup.body.children) if soup.body else []
         for child in body_children:
-            if isinstance(child, NavigableString) and not child.strip():
-                if current_soup.body: current_soup.body.append(child.extract() if hasattr(child, 'extract') else child)
-                continue
-            if current_idx + 1 < len(split_points):
-                next_node = split_points[current_idx + 1]['node']
-                is_nested_target = False
-                if hasattr(child, 'find_all'):
-                    if next_node in child.find_all(): is_nested_target = True
-                if next_node and (child == next_node or is_nested_target):
-                    chunks.append({'title': split_points[current_idx]['title'], 'soup': current_soup})
-                    current_idx += 1
-                    current_soup = BeautifulSoup("<body></body>", 'html.parser')
-            if current_soup.body: current_soup.body.append(child)
-        chunks.append({'title': split_points[current_idx]['title'], 'soup': current_soup})
+            is_blank = isinstance(child, NavigableString) and not child.strip()
+            if not is_blank and len(groups) < len(split_points) and id(child) in split_chains[len(groups)]:
+                groups.append([])
+            groups[-1].append(child)
+        chunks = []
+        for point, nodes in zip(split_points, groups):
+            html = "".join(n.output_ready() if isinstance(n, NavigableString) else n.decode() for n in nodes)
+            has_image = any(not isinstance(n, NavigableString) and (n.name == 'img' or n.find('img') is not None)
+                            for n in nodes)
+            chunks.append({'title': point['title'], 'html': f"<html><body>{html}</body></html>", 'has_image': has_image})
         return chunks
 
     def parse_structure(self, epub_bytes):
+        epub_digest = hashlib.sha256(epub_bytes).hexdigest()
+        success, result = _parse_epub_cached(epub_digest, epub_bytes, self.use_processes)
+        if not success: return False, result
+        self._load_structure(result)
+        self.epub_digest = epub_digest
+        return True, "Success"
+
+    def _dump_structure(self):
+        return {
+            'chapters': [(c['title'], c['filename'], c['has_image'], c['html']) for c in self.raw_chapters],
+            'cover_image': self.cover_image_bytes,
+            'global_id_map': self.global_id_map,
+            'book_lang': self.book_lang,
+            'book_images': self.book_images,
+            'book_css': self.book_css,
+        }
+
+    def _load_structure(self, data):
+        self.raw_chapters = [{'title': title, 'html': html, 'has_image': has_image, 'filename': filename}
+                             for title, filename, has_image, html in data['chapters']]
+        self.cover_image_bytes = data['cover_image']
+        self.cover_image_obj = Image.open(io.BytesIO(self.cover_image_bytes)) if self.cover_image_bytes else None
+        self.global_id_map = data['global_id_map']
+        self.notes_have_images = any('<img' in note for note in self.global_id_map.values())
+        self._body_cache = {}
+        self.book_lang = data['book_lang']
+        self.book_images = data['book_images']
+        self.book_image_uris = {}
+        self.book_css = data['book_css']
+        self.is_parsed = True
+
+    def _parse_structure_uncached(self, epub_bytes):
         self.raw_chapters = []
-        self.cover_image_obj = None
-        epub_temp_path = os.path.join(self.temp_dir.name, "input.epub")
-        with open(epub_temp_path, "wb") as f:
-            f.write(epub_bytes)
+        self.cover_image_bytes = None
         try:
-            book = epub.read_epub(epub_temp_path)
+            book = epub.read_epub(io.BytesIO(epub_bytes))
         except Exception as e:
             return False, f"Error reading EPUB: {e}"
-        self.cover_image_obj = self._find_cover_image(book)
+        id_to_item = {item.id: item for item in book.get_items()}
+        self.cover_image_bytes = self._find_cover_bytes(book, id_to_item)
         self.global_id_map = self._build_global_id_map(book)
         try:
             self.book_lang = book.get_metadata('DC', 'language')[0][0]
         except:
             self.book_lang = 'en'
-        self.book_images = extract_images_to_base64(book)
+        self.book_images = extract_images(book)
+        self.book_image_uris = {}
         self.book_css = extract_all_css(book)
         toc_mapping = get_official_toc_mapping(book)
-        items = [book.get_item_with_id(i[0]) for i in book.spine if
-                 isinstance(book.get_item_with_id(i[0]), epub.EpubHtml)]
+        items = [id_to_item[i[0]] for i in book.spine if isinstance(id_to_item.get(i[0]), epub.EpubHtml)]
         for item in items:
             item_filename = os.path.basename(item.get_name())
             raw_html = item.get_content().decode('utf-8', errors='replace')
-            soup = BeautifulSoup(raw_html, 'html.parser')
-            has_image = bool(soup.find('img'))
             toc_entries = toc_mapping.get(item_filename)
             if toc_entries and len(toc_entries) > 1:
+                soup = BeautifulSoup(raw_html, HTML_PARSER)
                 split_chapters = self._split_html_by_toc(soup, toc_entries)
                 for chunk in split_chapters:
-                    self.raw_chapters.append(
-                        {'title': chunk['title'], 'soup': chunk['soup'], 'has_image': bool(chunk['soup'].find('img')),
-                         'filename': item_filename})
+                    self.raw_chapters.append(dict(chunk, filename=item_filename))
             else:
+                # Unsplit chapters are stored as-is; a tree is only built to look for a heading title
                 chapter_title = toc_entries[0][1] if toc_entries else None
                 if not chapter_title:
-                    for tag in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
-                        header = soup.find(tag)
+                    headings = BeautifulSoup(raw_html, HTML_PARSER, parse_only=SoupStrainer(HEADING_TAGS))
+                    for tag in HEADING_TAGS:
+                        header = headings.find(tag)
                         if header:
                             t = header.get_text().strip()
                             if t and len(t) < 150: chapter_title = t; break
                     if not chapter_title: chapter_title = f"Section {len(self.raw_chapters) + 1}"
                 self.raw_chapters.append(
-                    {'title': chapter_title, 'soup': soup, 'has_image': has_image, 'filename': item_filename})
+                    {'title': chapter_title, 'html': raw_html, 'has_image': '<img' in raw_html.lower(),
+                     'filename': item_filename})
         self.is_parsed = True
         return True, "Success"
 
-    def _draw_progress_bar(self, draw, y, height, global_page_index):
+    def _draw_progress_bar(self, img, draw, y, height, global_page_index):
         if self.total_pages <= 0: return
         s = self.layout_settings
         show_ticks = s.get("bar_show_ticks", True)
@@ -447,27 +679,53 @@ class EpubProcessor:
         show_marker = s.get("bar_show_marker", True)
         marker_r = s.get("bar_marker_radius", 5)
         marker_col_str = s.get("bar_marker_color", "Black")
-        marker_fill = (255, 255, 255) if marker_col_str == "White" else (0, 0, 0)
-        draw.rectangle([10, y, self.screen_width - 10, y + height], fill=(255, 255, 255), outline=(0, 0, 0))
-        if show_ticks:
-            bar_center_y = y + (height / 2)
-            t_top = bar_center_y - (tick_h / 2)
-            t_bot = bar_center_y + (tick_h / 2)
-            chapter_pages = [item[1] for item in self.toc_data_final]
-            for cp in chapter_pages:
-                mx = int(((cp - 1) / self.total_pages) * (self.screen_width - 20)) + 10
-                draw.line([mx, t_top, mx, t_bot], fill=(0, 0, 0), width=1)
+        marker_fill = 255 if marker_col_str == "White" else 0
         curr_page_disp = global_page_index + 1
         bar_width_px = self.screen_width - 20
         fill_width = int((curr_page_disp / self.total_pages) * bar_width_px)
-        draw.rectangle([10, y, 10 + fill_width, y + height], fill=(0, 0, 0))
+        strip, strip_mask, top_offset = self._get_bar_strip(height, tick_h, show_ticks, fill_width)
+        img.paste(strip, (10, y + top_offset), strip_mask)
         if show_marker:
             cx = 10 + fill_width
             cy = y + (height / 2)
             draw.ellipse([cx - marker_r, cy - marker_r, cx + marker_r, cy + marker_r], fill=marker_fill,
-                         outline=(0, 0, 0))
+                         outline=0)
+
+    def _get_bar_strip(self, height, tick_h, show_ticks, fill_width):
+        """Outlined bar + chapter ticks + fill for one fill width, built once per render pass."""
+        key = (height, tick_h, show_ticks, fill_width)
+        if key not in self._bar_strips:
+            span = self.screen_width - 20
+            show_ticks = show_ticks and bool(self.toc_data_final)
+            # Pillow truncates the float end points of a tick line; y is an integer, so flooring the offsets matches
+            t_top = math.floor((height - tick_h) / 2)
+            t_bot = math.floor((height + tick_h) / 2)
+            r_top = min(0, t_top) if show_ticks else 0
+            r_bot = max(height, t_bot) if show_ticks else height
+            values = np.full((r_bot - r_top + 1, span + 1), 255, dtype=np.uint8)
+            mask = np.zeros_like(values)
+            bar_rows = slice(-r_top, height - r_top + 1)
+            mask[bar_rows, :] = 255
+            values[[-r_top, height - r_top], :] = 0
+            values[bar_rows, [0, span]] = 0
+            if show_ticks:
+                chapter_pages = np.array([item[1] for item in self.toc_data_final], dtype=np.float64)
+                cols = (((chapter_pages - 1) / self.total_pages) * span).astype(np.intp)
+                tick_rows = slice(t_top - r_top, t_bot - r_top + 1)
+                values[tick_rows, cols] = 0
+                mask[tick_rows, cols] = 255
+            values[bar_rows, :fill_width + 1] = 0
+            self._bar_strips[key] = (Image.fromarray(values, "L"), Image.fromarray(mask, "L"), r_top)
+        return self._bar_strips[key]
 
     def _get_page_text_elements(self, global_page_index):
+        # Header and footer both ask for the same page; compute it once
+        cached = self._page_text_cache.get(global_page_index)
+        if cached is None:
+            cached = self._page_text_cache[global_page_index] = self._compute_page_text_elements(global_page_index)
+        return cached
+
+    def _compute_page_text_elements(self, global_page_index):
         page_num_disp = global_page_index + 1
         percent = int((page_num_disp / self.total_pages) * 100) if self.total_pages > 0 else 0
         current_title = ""
@@ -476,12 +734,13 @@ class EpubProcessor:
             current_title = "Table of Contents"
             chap_page_disp = f"{global_page_index + 1}/{num_toc}"
         else:
-            for title, start_pg in reversed(self.toc_data_final):
-                if page_num_disp >= start_pg: current_title = title; break
+            if self._toc_starts is None: self._toc_starts = [start_pg for _, start_pg in self.toc_data_final]
+            toc_idx = bisect.bisect_right(self._toc_starts, page_num_disp) - 1
+            if toc_idx >= 0: current_title = self.toc_data_final[toc_idx][0]
             pm_idx = global_page_index - num_toc
             if 0 <= pm_idx < len(self.page_map):
                 doc_idx, page_idx = self.page_map[pm_idx]
-                doc_ref = self.fitz_docs[doc_idx][0]
+                doc_ref = self._get_doc(doc_idx)[0]
                 chap_total = len(doc_ref)
                 chap_page_disp = f"{page_idx + 1}/{chap_total}"
             else:
@@ -508,9 +767,7 @@ class EpubProcessor:
         display_title = title_item if title_item else ""
         if title_item:
             if font.getlength(title_item) > available_for_title:
-                t = title_item
-                while len(t) > 0 and font.getlength(t + "...") > available_for_title: t = t[:-1]
-                display_title = t + "..." if t else ""
+                display_title = truncate_to_width(font, title_item, available_for_title)
         final_strings = []
         for key, txt in elements_list:
             if key == 'title':
@@ -519,15 +776,15 @@ class EpubProcessor:
                 final_strings.append(txt)
         final_strings = [s for s in final_strings if s]
         if align == "Justify" and len(final_strings) > 1:
-            draw.text((margin_x, y), final_strings[0], font=font, fill=(0, 0, 0))
+            draw.text((margin_x, y), final_strings[0], font=font, fill=0)
             last_txt = final_strings[-1]
             last_w = font.getlength(last_txt)
-            draw.text((self.screen_width - margin_x - last_w, y), last_txt, font=font, fill=(0, 0, 0))
+            draw.text((self.screen_width - margin_x - last_w, y), last_txt, font=font, fill=0)
             if len(final_strings) > 2:
                 mid_txt = separator.join(final_strings[1:-1])
                 mid_w = font.getlength(mid_txt)
                 mid_x = (self.screen_width - mid_w) // 2
-                draw.text((mid_x, y), mid_txt, font=font, fill=(0, 0, 0))
+                draw.text((mid_x, y), mid_txt, font=font, fill=0)
         else:
             full_line = separator.join(final_strings)
             line_w = font.getlength(full_line)
@@ -537,9 +794,9 @@ class EpubProcessor:
                 x = self.screen_width - margin_x - line_w
             else:
                 x = margin_x
-            draw.text((x, y), full_line, font=font, fill=(0, 0, 0))
+            draw.text((x, y), full_line, font=font, fill=0)
 
-    def _draw_header(self, draw, global_page_index):
+    def _draw_header(self, img, draw, global_page_index):
         s = self.layout_settings
         font_size, margin, align = s.get("header_font_size", 16), s.get("header_margin", 10), s.get("header_align",
                                                                                                     "Center")
@@ -551,18 +808,18 @@ class EpubProcessor:
         gap = 6
         if "Header" in pos_prog:
             if "Above" in pos_prog:
-                self._draw_progress_bar(draw, curr_y, bar_h, global_page_index)
+                self._draw_progress_bar(img, draw, curr_y, bar_h, global_page_index)
                 curr_y += bar_h + gap
                 if elements: self._draw_text_line(draw, curr_y, font_ui, elements, align)
             else:
                 if elements:
                     self._draw_text_line(draw, curr_y, font_ui, elements, align)
                     curr_y += font_size + gap
-                self._draw_progress_bar(draw, curr_y, bar_h, global_page_index)
+                self._draw_progress_bar(img, draw, curr_y, bar_h, global_page_index)
         elif elements:
             self._draw_text_line(draw, curr_y, font_ui, elements, align)
 
-    def _draw_footer(self, draw, global_page_index):
+    def _draw_footer(self, img, draw, global_page_index):
         s = self.layout_settings
         font_size, margin, align = s.get("footer_font_size", 16), s.get("footer_margin", 10), s.get("footer_align",
                                                                                                     "Center")
@@ -576,13 +833,13 @@ class EpubProcessor:
             if "Below" in pos_prog:
                 bar_y = base_y - bar_h
                 text_y = bar_y - gap - font_size
-                self._draw_progress_bar(draw, bar_y, bar_h, global_page_index)
+                self._draw_progress_bar(img, draw, bar_y, bar_h, global_page_index)
                 if elements: self._draw_text_line(draw, text_y, font_ui, elements, align)
             else:
                 text_y = base_y - font_size
                 bar_y = text_y - gap - bar_h
                 if elements: self._draw_text_line(draw, text_y, font_ui, elements, align)
-                self._draw_progress_bar(draw, bar_y, bar_h, global_page_index)
+                self._draw_progress_bar(img, draw, bar_y, bar_h, global_page_index)
         elif elements:
             self._draw_text_line(draw, base_y - font_size, font_ui, elements, align)
 
@@ -616,72 +873,49 @@ class EpubProcessor:
             self.screen_width, self.screen_height = DEFAULT_SCREEN_HEIGHT, DEFAULT_SCREEN_WIDTH
         else:
             self.screen_width, self.screen_height = DEFAULT_SCREEN_WIDTH, DEFAULT_SCREEN_HEIGHT
-        for doc, _ in self.fitz_docs: doc.close()
-        self.fitz_docs, self.page_map = [], []
-        font_rules = []
-        font_family_val = "serif"
-        if is_custom_font:
-            def add_font_rule(path, weight="normal", style="normal"):
-                if path and os.path.exists(path):
-                    css_path = path.replace("\\", "/")
-                    return f'@font-face {{ font-family: "CustomFont"; src: url("{css_path}"); font-weight: {weight}; font-style: {style}; }}'
-                return ""
-
-            if self.font_data.get("regular"): font_rules.append(
-                add_font_rule(self.font_data["regular"], "normal", "normal"))
-            if self.font_data.get("bold"): font_rules.append(add_font_rule(self.font_data["bold"], "bold", "normal"))
-            if self.font_data.get("italic"): font_rules.append(
-                add_font_rule(self.font_data["italic"], "normal", "italic"))
-            if self.font_data.get("bold_italic"): font_rules.append(
-                add_font_rule(self.font_data["bold_italic"], "bold", "italic"))
-            font_family_val = '"CustomFont"'
-        else:
-            if self.font_data in ["serif", "sans-serif", "monospace", "cursive", "fantasy"]:
-                font_family_val = self.font_data
-            else:
-                font_family_val = f'"{self.font_data}"'
-        font_face_block = "\n".join(font_rules)
-        patched_css = fix_css_font_paths(self.book_css, font_family_val)
-        custom_css = f"""<style>
-            {font_face_block}
-            @page {{ size: {self.screen_width}pt {self.screen_height}pt; margin: 0; }}
-            body, p, div, span, li, blockquote, dd, dt {{ font-family: {font_family_val} !important; font-size: {self.font_size}pt !important; font-weight: {self.font_weight} !important; line-height: {self.line_height} !important; text-align: {self.text_align} !important; color: black !important; overflow-wrap: break-word; }}
-            body {{ margin: 0 !important; padding: {self.margin}px !important; background-color: white !important; width: 100% !important; height: 100% !important; }}
-            img {{ max-width: 95% !important; height: auto !important; display: block; margin: 20px auto !important; }}
-            h1, h2, h3 {{ text-align: center !important; margin-top: 1em; font-weight: {min(900, self.font_weight + 200)} !important; }}
-            .fn-marker {{ font-weight: bold; font-size: 0.7em !important; vertical-align: super; color: solid black !important; }}
-            .inline-footnote-box {{ display: block; margin: 15px 0px; padding: 0px 15px; border-left: 4px solid solid black; font-size: {int(self.font_size * 0.85)}pt !important; line-height: {self.line_height} !important; }}
-            .inline-footnote-box p {{ margin: 0 !important; padding: 0 !important; font-size: inherit !important; display: inline; }}
-        </style>"""
+        self.close()
+        self.page_map, self.chapter_sources = [], []
+        self._bar_strips = {}
+        self._page_text_cache, self._toc_starts = {}, None
+        # layout_settings only steer post-processing and overlays, so they stay out of the layout key
+        layout_key = (self.epub_digest, tuple(sorted(selected_indices_set)), font_data_input, font_size, margin,
+                      line_height, font_weight, bottom_padding, top_padding, text_align, orientation, add_toc,
+                      show_footnotes)
+        self.is_ready = False
+        layout_state = _layout_chapters_cached(layout_key, self, (selected_indices_set, add_toc, show_footnotes))
+        if not self.is_ready:
+            # Same book and layout inputs as an earlier pass: reuse its pagination, rebuild the chapter HTML here
+            # (bodies usually come from _body_cache) and reopen chapters on first access
+            for name in self._LAYOUT_STATE_ATTRS:
+                setattr(self, name, layout_state[name])
+            self._build_chapter_sources(show_footnotes, lambda idx, label, base: None)
+            self.fitz_docs = [(None, chapter['has_image']) for chapter in self.raw_chapters]
+            self.is_ready = True
+        return True
+
+    def _layout_chapters(self, selected_indices_set, add_toc, show_footnotes):
         temp_chapter_starts = []
         running_page_count = 0
         final_toc_titles = []
         progress_bar = st.progress(0)
         status_text = st.empty()
         total_chapters = len(self.raw_chapters)
-        for idx, chapter in enumerate(self.raw_chapters):
-            status_text.text(f"Rendering chapter {idx + 1}/{total_chapters}...")
-            progress_bar.progress(int((idx / total_chapters) * 90))
-            soup = chapter['soup']
-            if show_footnotes: soup = self._inject_inline_footnotes(soup, chapter.get('filename', ''))
-            for img_tag in soup.find_all('img'):
-                src = os.path.basename(img_tag.get('src', ''))
-                if src in self.book_images: img_tag['src'] = self.book_images[src]
-            soup = hyphenate_html_text(soup, self.book_lang)
-            if idx in selected_indices_set:
+        # Each widget update is a websocket message; books with hundreds of short chapters don't need one per chapter
+        update_every = max(1, total_chapters // 50)
+        def report_progress(idx, label, base):
+            if idx % update_every == 0:
+                status_text.text(f"{label} chapter {idx + 1}/{total_chapters}...")
+                progress_bar.progress(base + int((idx / total_chapters) * 45))
+
+        self._build_chapter_sources(show_footnotes, report_progress)
+        page_counts = self._layout_chapter_sources(lambda idx: report_progress(idx, "Laying out", 45))
+        # Every chapter gets a doc, so the chapter index doubles as the doc index
+        for doc_idx, (chapter, page_count) in enumerate(zip(self.raw_chapters, page_counts)):
+            if doc_idx in selected_indices_set:
                 temp_chapter_starts.append(running_page_count)
                 final_toc_titles.append(chapter['title'])
-            body_content = "".join([str(x) for x in soup.body.contents]) if soup.body else str(soup)
-            final_html = f"<html lang='{self.book_lang}'><head><style>{patched_css}</style>{custom_css}</head><body>{body_content}</body></html>"
-            temp_html_path = os.path.join(self.temp_dir.name, f"render_{idx}.html")
-            with open(temp_html_path, "w", encoding="utf-8") as f:
-                f.write(final_html)
-            doc = fitz.open(temp_html_path)
-            rect = fitz.Rect(0, 0, self.screen_width, self.screen_height)
-            doc.layout(rect=rect)
-            self.fitz_docs.append((doc, chapter['has_image']))
-            for i in range(len(doc)): self.page_map.append((len(self.fitz_docs) - 1, i))
-            running_page_count += len(doc)
+            self.page_map.extend(zip(itertools.repeat(doc_idx), range(page_count)))
+            running_page_count += page_count
         if add_toc and final_toc_titles:
             toc_header_space = 100 + self.top_padding
             self.toc_row_height = int(self.font_size * self.line_height * 1.2)
@@ -690,7 +924,13 @@ class EpubProcessor:
             num_toc_pages = (len(final_toc_titles) + self.toc_items_per_page - 1) // self.toc_items_per_page
             self.toc_data_final = [(t, temp_chapter_starts[i] + num_toc_pages + 1) for i, t in
                                    enumerate(final_toc_titles)]
-            self.toc_pages_images = self._render_toc_pages(self.toc_data_final)
+            # TOC pages only depend on these inputs; unrelated setting changes reuse the last images
+            toc_key = (tuple(self.toc_data_final), self.font_size, self.toc_row_height, self.toc_items_per_page,
+                       self.top_padding, self.screen_width, self.screen_height, self.ui_font_ref)
+            if toc_key != self._toc_cache_key:
+                self._toc_cache_key = toc_key
+                self._toc_cache_pages = self._render_toc_pages(self.toc_data_final)
+            self.toc_pages_images = self._toc_cache_pages
         else:
             self.toc_data_final = [(t, temp_chapter_starts[i] + 1) for i, t in enumerate(final_toc_titles)]
             self.toc_pages_images = []
@@ -698,7 +938,122 @@ class EpubProcessor:
         status_text.empty();
         progress_bar.empty();
         self.is_ready = True
-        return True
+        return {name: getattr(self, name) for name in self._LAYOUT_STATE_ATTRS}
+
+    def _build_chapter_sources(self, show_footnotes, report_progress):
+        """Fills chapter_sources with every chapter's full HTML; bodies come from _body_cache when possible."""
+        is_custom_font = isinstance(self.font_data, dict)
+        font_face_block = ""
+        if is_custom_font:
+            font_face_block = self._get_font_face_block()
+            font_family_val = '"CustomFont"'
+        else:
+            if self.font_data in GENERIC_FONT_FAMILIES:
+                font_family_val = self.font_data
+            else:
+                font_family_val = f'"{self.font_data}"'
+        patched_css = fix_css_font_paths(self.book_css, font_family_val)
+        custom_css = f"""
+            {font_face_block}
+            @page {{ size: {self.screen_width}pt {self.screen_height}pt; margin: 0; }}
+            body, p, div, span, li, blockquote, dd, dt {{ font-family: {font_family_val} !important; font-size: {self.font_size}pt !important; font-weight: {self.font_weight} !important; line-height: {self.line_height} !important; text-align: {self.text_align} !important; color: black !important; overflow-wrap: break-word; }}
+            body {{ margin: 0 !important; padding: {self.margin}px !important; background-color: white !important; width: 100% !important; height: 100% !important; }}
+            img {{ max-width: 95% !important; height: auto !important; display: block; margin: 20px auto !important; }}
+            h1, h2, h3 {{ text-align: center !important; margin-top: 1em; font-weight: {min(900, self.font_weight + 200)} !important; }}
+            .fn-marker {{ font-weight: bold; font-size: 0.7em !important; vertical-align: super; color: solid black !important; }}
+            .inline-footnote-box {{ display: block; margin: 15px 0px; padding: 0px 15px; border-left: 4px solid solid black; font-size: {int(self.font_size * 0.85)}pt !important; line-height: {self.line_height} !important; }}
+            .inline-footnote-box p {{ margin: 0 !important; padding: 0 !important; font-size: inherit !important; display: inline; }}
+        """
+        # Minified once per pass; fitz re-tokenizes the CSS for every chapter
+        html_parts = {"lang": self.book_lang, "book_css": minify_css(patched_css), "reader_css": minify_css(custom_css)}
+        prepared = self._prepare_chapter_bodies(show_footnotes, lambda idx: report_progress(idx, "Preparing", 0))
+        for idx, chapter in enumerate(self.raw_chapters):
+            # The prepared body only depends on the chapter and the footnote toggle, not on layout settings
+            body_key = (idx, show_footnotes)
+            body_content = self._body_cache.get(body_key)
+            if body_content is None:
+                body_content = prepared.get(idx)
+                if body_content is None:
+                    report_progress(idx, "Preparing", 0)
+                    body_content = self._build_chapter_body(chapter, show_footnotes)
+                # Only look for images when the chapter (or an injected note) can contain one
+                if chapter['has_image'] or (show_footnotes and self.notes_have_images):
+                    body_content = self._inline_images(body_content)
+                self._body_cache[body_key] = body_content
+            html_parts["body"] = body_content
+            self.chapter_sources.append(CHAPTER_HTML_TEMPLATE.format_map(html_parts).encode("utf-8"))
+
+    def _build_chapter_body(self, chapter, show_footnotes):
+        """Footnotes + hyphenation for one chapter; images are inlined afterwards by _inline_images."""
+        soup = BeautifulSoup(chapter['html'], HTML_PARSER)
+        if show_footnotes: soup = self._inject_inline_footnotes(soup, chapter.get('filename', ''))
+        soup = hyphenate_html_text(soup, self.book_lang)
+        return soup.body.decode_contents() if soup.body else str(soup)
+
+    def _inline_images(self, body_content):
+        book_images, basename = self.book_images, os.path.basename
+        def replace_src(match):
+            src = basename(html.unescape(match.group(3)))
+            if src not in book_images: return match.group(0)
+            return f'{match.group(1)}"{self._get_image_uri(src)}"'
+        return IMG_SRC_RE.sub(replace_src, body_content)
+
+    def _prepare_chapter_bodies(self, show_footnotes, report_progress):
+        """Builds uncached chapter bodies in a process pool for large books; returns {chapter index: body}."""
+        missing = [idx for idx in range(len(self.raw_chapters)) if (idx, show_footnotes) not in self._body_cache]
+        workers = _parallel_workers() if self.use_processes else 1
+        if workers < 2 or sum(len(self.raw_chapters[idx]['html']) for idx in missing) < PARALLEL_PREPARE_MIN_BYTES:
+            return {}
+        # Workers only need the note map and language; book images stay in this process
+        state = {'global_id_map': self.global_id_map if show_footnotes else {}, 'book_lang': self.book_lang}
+        prepared = {}
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_prepare_worker,
+                                                        initargs=(state,)) as executor:
+                chapters = [self.raw_chapters[idx] for idx in missing]
+                bodies = executor.map(_prepare_chapter_body, chapters, itertools.repeat(show_footnotes))
+                for idx, body_content in zip(missing, bodies):
+                    report_progress(idx)
+                    prepared[idx] = body_content
+        except Exception:
+            # Process pools can be unavailable on constrained hosts; whatever is missing is built here
+            logger.warning("Chapter preparation pool failed, preparing the rest in-process", exc_info=True)
+        return prepared
+
+    def _layout_chapter_sources(self, report_progress):
+        """Lays out every chapter HTML in chapter_sources, fills fitz_docs and returns the page counts."""
+        rect = fitz.Rect(0, 0, self.screen_width, self.screen_height)
+        has_images = [chapter['has_image'] for chapter in self.raw_chapters]
+        page_counts = []
+        for idx, (html_bytes, has_image) in enumerate(zip(self.chapter_sources, has_images)):
+            report_progress(idx)
+            doc = fitz.open(stream=html_bytes, filetype="html")
+            doc.layout(rect=rect)
+            self.fitz_docs.append((doc, has_image))
+            page_counts.append(len(doc))
+        return page_counts
+
+    def _get_font_face_block(self):
+        """@font-face rules for the custom font set, rebuilt only when the font files change."""
+        font_key = tuple(sorted(self.font_data.items()))
+        if font_key == self._font_face_key: return self._font_face_block
+
+        font_rules = []
+        for variant, weight, style in FONT_FACE_VARIANTS:
+            path = self.font_data.get(variant)
+            if path and os.path.exists(path):
+                css_path = path.replace("\\", "/")
+                font_rules.append(f'@font-face {{ font-family: "CustomFont"; src: url("{css_path}"); '
+                                  f'font-weight: {weight}; font-style: {style}; }}')
+        self._font_face_key, self._font_face_block = font_key, "\n".join(font_rules)
+        return self._font_face_block
+
+    def _get_image_uri(self, filename):
+        uri = self.book_image_uris.get(filename)
+        if uri is None:
+            uri = image_to_data_uri(*self.book_images[filename])
+            self.book_image_uris[filename] = uri
+        return uri
 
     def _get_ui_font(self, size):
         return get_pil_font(self.ui_font_ref, int(size))
@@ -708,44 +1063,79 @@ class EpubProcessor:
         main_size, header_size = self.font_size, int(self.font_size * 1.2)
         font_main, font_header = self._get_ui_font(main_size), self._get_ui_font(header_size)
         left_margin, right_margin, column_gap, limit = 40, 40, 20, self.toc_items_per_page
+        # Locals for the per-entry loop
+        screen_w, screen_h, row_h = self.screen_width, self.screen_height, self.toc_row_height
+        getlength = font_main.getlength
+        dot_w = getlength(".")
+        dot_row = "." * (int(screen_w / dot_w) + 1) if dot_w > 0 else ""
         for i in range(0, len(toc_entries), limit):
             chunk = toc_entries[i: i + limit]
-            img = Image.new('1', (self.screen_width, self.screen_height), 1)
+            img = Image.new('1', (screen_w, screen_h), 1)
             draw = ImageDraw.Draw(img)
+            draw_text = draw.text
             header_text = "TABLE OF CONTENTS"
             header_w = font_header.getlength(header_text)
             header_y = 40 + self.top_padding
-            draw.text(((self.screen_width - header_w) // 2, header_y), header_text, font=font_header, fill=0)
+            draw_text(((screen_w - header_w) // 2, header_y), header_text, font=font_header, fill=0)
             line_y = header_y + int(header_size * 1.5)
-            draw.line((left_margin, line_y, self.screen_width - right_margin, line_y), fill=0)
+            draw.line((left_margin, line_y, screen_w - right_margin, line_y), fill=0)
             y = line_y + int(main_size * 1.2)
             for title, pg_num in chunk:
                 pg_str = str(pg_num)
-                pg_w = font_main.getlength(pg_str)
-                max_title_w = self.screen_width - left_margin - right_margin - pg_w - column_gap
-                display_title = title
-                if font_main.getlength(display_title) > max_title_w:
-                    while font_main.getlength(display_title + "...") > max_title_w and len(
-                        display_title) > 0: display_title = display_title[:-1]
-                    display_title += "..."
-                draw.text((left_margin, y), display_title, font=font_main, fill=0)
-                title_end_x = left_margin + font_main.getlength(display_title) + 5
-                dots_end_x = self.screen_width - right_margin - pg_w - 10
-                if dots_end_x > title_end_x:
-                    try:
-                        dot_w = font_main.getlength(".")
-                        if dot_w > 0:
-                            dots_count = int((dots_end_x - title_end_x) / dot_w)
-                            draw.text((title_end_x, y), "." * dots_count, font=font_main, fill=0)
-                    except:
-                        pass
-                draw.text((self.screen_width - right_margin - pg_w, y), pg_str, font=font_main, fill=0)
-                y += self.toc_row_height
+                pg_w = getlength(pg_str)
+                max_title_w = screen_w - left_margin - right_margin - pg_w - column_gap
+                display_title, title_w = title, getlength(title)
+                if title_w > max_title_w:
+                    display_title = truncate_to_width(font_main, title, max_title_w) or "..."
+                    title_w = getlength(display_title)
+                draw_text((left_margin, y), display_title, font=font_main, fill=0)
+                title_end_x = left_margin + title_w + 5
+                dots_end_x = screen_w - right_margin - pg_w - 10
+                if dot_row and dots_end_x > title_end_x:
+                    dots_count = int((dots_end_x - title_end_x) / dot_w)
+                    draw_text((title_end_x, y), dot_row[:dots_count], font=font_main, fill=0)
+                draw_text((screen_w - right_margin - pg_w, y), pg_str, font=font_main, fill=0)
+                y += row_h
             pages.append(img)
         return pages
 
-    def render_page(self, global_page_index):
-        if not self.is_ready: return None
+    def _get_cached_page(self, global_page_index):
+        # Returns the shared cached image; callers must not modify it
+        img = self._page_cache.get(global_page_index)
+        if img is None:
+            img = self._render_page_uncached(global_page_index)
+            self._page_cache[global_page_index] = img
+            if len(self._page_cache) > PREVIEW_PAGE_CACHE_SIZE: self._page_cache.popitem(last=False)
+        else:
+            self._page_cache.move_to_end(global_page_index)
+        return img
+
+    def get_preview_png(self, global_page_index, base_size):
+        """Scaled PNG for the preview pane, cached per (page, zoom) until the next render_chapters pass."""
+        key = (global_page_index, base_size)
+        cached = self._preview_cache.get(key)
+        if cached is not None:
+            self._preview_cache.move_to_end(key)
+            return cached
+        # resize() returns a new image, so the cached page can be read without copying it first
+        img = self._get_cached_page(global_page_index)
+        if img.width > img.height:
+            target_h = base_size
+            target_w = int(target_h * (img.width / img.height))
+        else:
+            target_w = base_size
+            target_h = int(target_w * (img.height / img.width))
+
+        preview_img = img.resize((target_w, target_h), Image.Resampling.LANCZOS)
+        # Encode ourselves with fast zlib settings; Streamlit's own PNG encode uses the slow default level
+        with io.BytesIO() as buffer:
+            preview_img.save(buffer, format="PNG", compress_level=1)
+            cached = (buffer.getvalue(), target_w)
+        self._preview_cache[key] = cached
+        if len(self._preview_cache) > PREVIEW_PAGE_CACHE_SIZE: self._preview_cache.popitem(last=False)
+        return cached
+
+    def _render_page_uncached(self, global_page_index):
 
         # --- 1. GET RENDER SETTINGS ---
         mode = self.layout_settings.get("render_mode", DEFAULT_RENDER_MODE)
@@ -755,9 +1145,10 @@ class EpubProcessor:
         contrast = self.layout_settings.get("contrast", DEFAULT_CONTRAST)
 
         num_toc = len(self.toc_pages_images)
+        screen_w, screen_h = self.screen_width, self.screen_height
         footer_padding = max(0, self.bottom_padding)
         header_padding = max(0, self.top_padding)
-        content_height = self.screen_height - footer_padding - header_padding
+        content_height = screen_h - footer_padding - header_padding
         if content_height < 1: content_height = 1
 
         # --- 2. PREPARE CONTENT LAYER ---
@@ -765,12 +1156,12 @@ class EpubProcessor:
 
         if global_page_index < num_toc:
             # Table of Contents
-            img_content = self.toc_pages_images[global_page_index].copy().convert("L")
+            img_content = self.toc_pages_images[global_page_index].convert("L")
             is_toc = True
         else:
             is_toc = False
             doc_idx, page_idx = self.page_map[global_page_index - num_toc]
-            doc, has_image_content = self.fitz_docs[doc_idx]
+            doc, has_image_content = self._get_doc(doc_idx)
             page = doc[page_idx]
 
             # --- OPTIMIZATION: Direct Rendering ---
@@ -778,23 +1169,25 @@ class EpubProcessor:
             src_h = page.rect.height
 
             # Calculate exact scale to fill width/height
-            sx = self.screen_width / src_w
+            sx = screen_w / src_w
             sy = content_height / src_h
 
             mat = fitz.Matrix(sx, sy)
+            # RGB + Pillow's L conversion on purpose: fitz's own grey colorspace rounds differently and
+            # drops thin underlines at the text threshold
             pix = page.get_pixmap(matrix=mat, alpha=False)
-
-            # Fast creation
-            img_content = Image.frombytes("RGB", [pix.width, pix.height], pix.samples).convert("L")
+            img_content = Image.frombytes("RGB", (pix.width, pix.height), pix.samples).convert("L")
 
         # --- 3. APPLY FILTERS ---
-        full_page = Image.new("L", (self.screen_width, self.screen_height), 255)
+        full_page = Image.new("L", (screen_w, screen_h), 255)
         paste_y = 0 if is_toc else header_padding
 
         # Center horizontally if there's a slight pixel mismatch
-        paste_x = (self.screen_width - img_content.width) // 2
+        paste_x = (screen_w - img_content.width) // 2
         full_page.paste(img_content, (paste_x, paste_y))
 
+        # Filters see the whole page, white header/footer strips included: the contrast mean and the
+        # sharpen/dither edges depend on them
         if not is_toc:
             use_dither = False
             if mode == "Dither":
@@ -803,106 +1196,212 @@ class EpubProcessor:
                 use_dither = has_image_content
 
             if use_dither:
-                if contrast != 1.0:
-                    full_page = ImageEnhance.Contrast(full_page).enhance(contrast)
-                if white_clip < 255:
-                    full_page = full_page.point(lambda p: 255 if p > white_clip else p)
+                if contrast != 1.0 or white_clip < 255:
+                    # Fused into a single pass; only the page mean has to be measured per page
+                    mean = int(ImageStat.Stat(full_page).mean[0] + 0.5) if contrast != 1.0 else 0
+                    full_page = full_page.point(tone_lut(mean, contrast, white_clip))
                 full_page = full_page.convert("1", dither=Image.Dither.FLOYDSTEINBERG).convert("L")
             else:
                 if sharpness_val > 0:
                     enhancer = ImageEnhance.Sharpness(full_page)
                     full_page = enhancer.enhance(1.0 + (sharpness_val * 0.5))
-                full_page = full_page.point(lambda p: 255 if p > threshold_val else 0).convert("L")
+                full_page = full_page.point(threshold_lut(threshold_val, 0))
 
         # --- 4. OVERLAYS ---
-        img_final = full_page.convert("RGB")
+        img_final = full_page
         draw = ImageDraw.Draw(img_final)
 
         if not is_toc:
-            # Mask out header/footer areas
+            # Mask out header/footer areas (solid fills via paste; same boxes as the inclusive rectangles)
             if header_padding > 0:
-                draw.rectangle([0, 0, self.screen_width, header_padding], fill=(255, 255, 255))
+                img_final.paste(255, (0, 0, screen_w, header_padding + 1))
             if footer_padding > 0:
-                draw.rectangle([0, self.screen_height - footer_padding, self.screen_width, self.screen_height],
-                               fill=(255, 255, 255))
+                img_final.paste(255, (0, screen_h - footer_padding, screen_w, screen_h))
 
-            self._draw_header(draw, global_page_index)
-            self._draw_footer(draw, global_page_index)
+            self._draw_header(img_final, draw, global_page_index)
+            self._draw_footer(img_final, draw, global_page_index)
 
         return img_final
 
-    def get_xtc_bytes(self):
-        if not self.is_ready: return None
+    def close(self):
+        """Closes the chapter documents and drops rendered pages; render_chapters reopens what it needs."""
+        for doc, _ in self.fitz_docs:
+            if doc is not None: doc.close()
+        self.fitz_docs = []
+        self._page_cache.clear()
+        self._preview_cache.clear()
+
+    def _get_doc(self, doc_idx):
+        doc, has_image = self.fitz_docs[doc_idx]
+        if doc is None:
+            # Export threads share this processor; the lock keeps two of them from opening the same chapter
+            with self._doc_lock:
+                doc, has_image = self.fitz_docs[doc_idx]
+                if doc is None:
+                    # Export workers reopen chapters from the rendered HTML on first use
+                    doc = fitz.open(stream=self.chapter_sources[doc_idx], filetype="html")
+                    doc.layout(rect=fitz.Rect(0, 0, self.screen_width, self.screen_height))
+                    self.fitz_docs[doc_idx] = (doc, has_image)
+        return doc, has_image
+
+    # What _layout_chapters_cached keeps; chapter HTML with inlined images is never stored in that shared cache
+    _LAYOUT_STATE_ATTRS = ("page_map", "total_pages", "toc_pages_images", "toc_data_final")
+
+    _EXPORT_STATE_ATTRS = ("layout_settings", "screen_width", "screen_height", "font_size", "top_padding",
+                           "bottom_padding", "ui_font_ref", "toc_pages_images", "toc_data_final", "page_map",
+                           "total_pages", "chapter_sources")
+
+    def _export_state(self):
+        state = {name: getattr(self, name) for name in self._EXPORT_STATE_ATTRS}
+        state["has_images"] = [has_image for _, has_image in self.fitz_docs]
+        return state
+
+    @classmethod
+    def from_export_state(cls, state):
+        processor = cls()
+        for name in cls._EXPORT_STATE_ATTRS:
+            setattr(processor, name, state[name])
+        processor.fitz_docs = [(None, has_image) for has_image in state["has_images"]]
+        processor.is_ready = True
+        return processor
+
+    def _render_xtg_page(self, i):
+        if i < len(self.toc_pages_images) and self.toc_pages_images[i].size == (self.screen_width, self.screen_height):
+            # TOC pages are already 1-bit at screen size and get no overlays; pack them as they are
+            img = self.toc_pages_images[i]
+            w, h = img.size
+            return img.tobytes(), w, h
+        # Export bypasses the preview cache: every page is visited once, and from several threads
+        img = self._render_page_uncached(i)
+        w, h = img.size
+        # Mode 1 rows are already XTG rows (MSB first, 1 = white). convert("1") dithers (Floyd-Steinberg),
+        # which is what keeps the anti-aliased header/footer text looking right on the device.
+        # The XTG header is written straight into the output buffer by get_xtc_bytes
+        return img.convert("1").tobytes(), w, h
+
+    def _iter_xtg_pages_threaded(self):
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            yield from enumerate(executor.map(self._render_xtg_page, range(self.total_pages)))
 
-        # We accumulate results in a list first to ensure order is maintained
-        blob_parts = [None] * self.total_pages
-        idx_parts = [None] * self.total_pages
+    def _iter_xtg_pages_multiprocess(self):
+        # One task per chapter document so every worker lays out each chapter it touches only once.
+        # Boundaries come from page_map, so chapters that were never opened in this process stay closed.
+        num_toc = len(self.toc_pages_images)
+        ranges = [(0, num_toc)] if num_toc else []
+        bounds = [num_toc + j for j, (_, page_idx) in enumerate(self.page_map) if page_idx == 0]
+        bounds.append(self.total_pages)
+        ranges.extend(zip(bounds, bounds[1:]))
+
+        workers = _parallel_workers()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_export_worker,
+                                                    initargs=(self._export_state(),)) as executor:
+            pending = {executor.submit(_export_page_range, start, stop) for start, stop in ranges}
+            for future in concurrent.futures.as_completed(pending):
+                # Drop finished chunks as soon as they are consumed
+                pending.discard(future)
+                for i, bitmap, w, h in future.result():
+                    yield i, (bitmap, w, h)
+
+    def get_xtc_bytes(self, use_processes=False):
+        if not self.is_ready: return None
 
-        data_off_start = 56 + (16 * self.total_pages)
-        current_data_offset = data_off_start
+        index_off = XTC_HEADER.size
+        data_off_start = index_off + XTC_INDEX_ENTRY.size * self.total_pages
+        w, h = self.screen_width, self.screen_height
+        xtg_header_size = XTG_HEADER.size
+        bitmap_size = ((w + 7) // 8) * h
+        # Every page (TOC included) is rendered at screen size, so all offsets are known up front
+        # and pages can be written into the output as soon as they are rendered.
+        page_size = xtg_header_size + bitmap_size
 
         prog_text = st.empty()
         prog_bar = st.progress(0)
 
-        # Worker function for parallel execution
-        def process_single_page(i):
-            img_rgb = self.render_page(i)
-            img = img_rgb.convert("1")
-            w, h = img.size
-            img_bytes = img.tobytes()
-            # XTG Header
-            xtg = struct.pack("<IHHBBIQ", 0x00475458, w, h, 0, 0, ((w + 7) // 8) * h, 0) + img_bytes
-            return i, xtg, w, h
+        def report_progress(count):
+            prog_text.text(f"Exporting page {count}/{self.total_pages}...")
+            prog_bar.progress(count / self.total_pages)
 
-        # Parallel Execution
-        # Use simple os.cpu_count() for max workers
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            # Submit all tasks
-            futures = [executor.submit(process_single_page, i) for i in range(self.total_pages)]
+        # Single buffer: header + index + (XTG header + bitmap) per page, filled in place
+        xtc_buf = bytearray(data_off_start + page_size * self.total_pages)
 
-            count = 0
-            for future in concurrent.futures.as_completed(futures):
-                count += 1
-                # Update UI periodically (every 5% or so to reduce overhead)
-                if count % max(1, self.total_pages // 20) == 0:
-                    prog_text.text(f"Exporting page {count}/{self.total_pages}...")
-                    prog_bar.progress(count / self.total_pages)
+        # Header
+        XTC_HEADER.pack_into(xtc_buf, 0,
+                             0x00435458, 0x0100, self.total_pages,
+                             0, 0, 0, 0, 0, 0,
+                             index_off, data_off_start,
+                             0, 0)
 
-                # Retrieve result
-                i, xtg_blob, w, h = future.result()
-                blob_parts[i] = xtg_blob
+        # Index
+        for i in range(self.total_pages):
+            XTC_INDEX_ENTRY.pack_into(xtc_buf, index_off + XTC_INDEX_ENTRY.size * i,
+                                      data_off_start + i * page_size, page_size, w, h)
+
+        def write_pages(results):
+            step = max(1, self.total_pages // 20)
+            # A memoryview refuses size-changing slice writes, unlike the bytearray itself
+            with memoryview(xtc_buf) as view:
+                for count, (i, (bitmap, _, _)) in enumerate(results, 1):
+                    offset = data_off_start + i * page_size
+                    XTG_HEADER.pack_into(view, offset, 0x00475458, w, h, 0, 0, bitmap_size, 0)
+                    view[offset + xtg_header_size:offset + page_size] = bitmap
+                    # Update UI periodically (every 5% or so to reduce overhead)
+                    if count % step == 0: report_progress(count)
+
+        written = False
+        if use_processes:
+            try:
+                write_pages(self._iter_xtg_pages_multiprocess())
+                written = True
+            except Exception:
+                # Process pools can be unavailable on constrained hosts; threads always work
+                logger.warning("Export process pool failed, exporting with threads", exc_info=True)
+        if not written:
+            write_pages(self._iter_xtg_pages_threaded())
 
-                # We can't generate the Index here yet because the offset depends on previous pages.
-                # We store the size/dims and calculate offsets sequentially after the loop.
-                idx_parts[i] = (len(xtg_blob), w, h)
+        prog_text.empty()
+        prog_bar.empty()
 
-        # Sequential Offset Calculation
-        final_idx = bytearray()
-        final_blob = bytearray()
+        return io.BytesIO(xtc_buf)
 
-        for i in range(self.total_pages):
-            size, w, h = idx_parts[i]
-            chunk = blob_parts[i]
 
-            # Add Index Entry
-            final_idx.extend(struct.pack("<QIHH", current_data_offset, size, w, h))
+_export_processor = None
+_prepare_processor = None
 
-            # Add Blob
-            final_blob.extend(chunk)
 
-            current_data_offset += size
+def _init_export_worker(state):
+    global _export_processor
+    _export_processor = EpubProcessor.from_export_state(state)
 
-        # Final Header
-        header = struct.pack("<IHHBBBBIQQQQQ",
-                             0x00435458, 0x0100, self.total_pages,
-                             0, 0, 0, 0, 0, 0,
-                             56, data_off_start,
-                             0, 0)
 
-        prog_text.empty()
-        prog_bar.empty()
+def _init_prepare_worker(state):
+    global _prepare_processor
+    _prepare_processor = EpubProcessor()
+    _prepare_processor.global_id_map = state['global_id_map']
+    _prepare_processor.book_lang = state['book_lang']
+
+
+def _prepare_chapter_body(chapter, show_footnotes):
+    return _prepare_processor._build_chapter_body(chapter, show_footnotes)
 
-        return io.BytesIO(header + final_idx + final_blob)
+
+def _export_page_range(start, stop):
+    return [(i, *_export_processor._render_xtg_page(i)) for i in range(start, stop)]
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _parse_epub_cached(epub_digest, _epub_bytes, _use_processes):
+    """Step 1 result keyed on EPUB content hash, shared across reruns and sessions."""
+    processor = EpubProcessor()
+    processor.use_processes = _use_processes
+    success, msg = processor._parse_structure_uncached(_epub_bytes)
+    if not success: return False, msg
+    return True, processor._dump_structure()
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _layout_chapters_cached(layout_key, _processor, _layout_args):
+    """Step 2 pagination keyed on the EPUB hash and the settings that affect layout; a hit skips chapter layout."""
+    return _processor._layout_chapters(*_layout_args)
 
 
 # --- STREAMLIT APP ---
@@ -949,12 +1448,10 @@ KEY_MAP = {
 
 def get_current_settings_for_export():
     """Gathers settings from Session State and maps to CTK keys."""
-    export_data = {}
-    for st_key, ctk_key in KEY_MAP.items():
-        if st_key in st.session_state:
-            export_data[ctk_key] = st.session_state[st_key]
-    if "font_name" not in export_data: export_data["font_name"] = "Default (System)"
-    if "preview_zoom" not in export_data: export_data["preview_zoom"] = 300
+    state = st.session_state.to_dict()
+    export_data = {ctk_key: state[st_key] for st_key, ctk_key in KEY_MAP.items() if st_key in state}
+    export_data.setdefault("font_name", "Default (System)")
+    export_data.setdefault("preview_zoom", 300)
     return json.dumps(export_data, indent=4)
 
 
@@ -1017,7 +1514,8 @@ def main():
             with col_dl:
                 if st.button("Download XTC", type="primary", use_container_width=True):
                     with st.spinner("Generating..."):
-                        xtc_data = st.session_state.processor.get_xtc_bytes()
+                        xtc_data = st.session_state.processor.get_xtc_bytes(
+                            use_processes=st.session_state.processor.use_processes)
                         original_name = st.session_state.file_key.rsplit('_', 1)[0]
                         base_name = os.path.splitext(original_name)[0]
                         out_name = f"{base_name}.xtc"
@@ -1030,8 +1528,15 @@ def main():
                         cv_w = st.number_input("Width", value=480)
                         cv_h = st.number_input("Height", value=800)
                         cv_mode = st.selectbox("Mode", ["Crop to Fill", "Fit", "Stretch"])
+                        cv_dither = st.selectbox("Binarization", ["Floyd-Steinberg", "Threshold"],
+                                                 help="Threshold is much faster and suits flat, graphic covers.")
                         if st.button("Generate BMP"):
                             img = st.session_state.processor.cover_image_obj.convert("RGB")
+                            # Pre-shrink to ~2x target so the final LANCZOS pass works on a small buffer
+                            pre_scale = min(img.width / (cv_w * 2), img.height / (cv_h * 2))
+                            if pre_scale > 1:
+                                img.thumbnail((int(img.width / pre_scale), int(img.height / pre_scale)),
+                                              Image.Resampling.LANCZOS)
                             if cv_mode == "Stretch":
                                 img = img.resize((cv_w, cv_h), Image.Resampling.LANCZOS)
                             elif cv_mode == "Fit":
@@ -1041,7 +1546,11 @@ def main():
                             img = img.convert("L")
                             img = ImageEnhance.Contrast(img).enhance(1.3)
                             img = ImageEnhance.Brightness(img).enhance(1.05)
-                            img = img.convert("1", dither=Image.Dither.FLOYDSTEINBERG)
+                            if cv_dither == "Threshold":
+                                bits = pack_bits(np.asarray(img) > 127)
+                                img = Image.frombytes("1", img.size, bits)
+                            else:
+                                img = img.convert("1", dither=Image.Dither.FLOYDSTEINBERG)
                             buf = io.BytesIO()
                             img.save(buf, format="BMP")
                             st.download_button("Download BMP", data=buf.getvalue(), file_name="cover.bmp")
@@ -1051,6 +1560,10 @@ def main():
 
         st.header("1. Input")
         uploaded_file = st.file_uploader("Upload EPUB", type=["epub"])
+        use_processes = st.checkbox("Use worker processes", value=False, key="use_processes",
+                                    help="Parse, prepare and export large books in parallel processes. "
+                                         "Faster on multi-core hosts, but uses more memory.")
+        st.session_state.processor.use_processes = use_processes
 
         font_mode = st.radio("Font Source", ["System (Built-in)", "Custom (Upload)"], horizontal=True)
         final_font_data = None
@@ -1074,7 +1587,10 @@ def main():
             file_key = f"{uploaded_file.name}_{uploaded_file.size}"
             if 'file_key' not in st.session_state or st.session_state.file_key != file_key:
                 st.session_state.file_key = file_key
+                # Free the previous book's documents now instead of whenever the old processor is collected
+                st.session_state.processor.close()
                 st.session_state.processor = EpubProcessor()
+                st.session_state.processor.use_processes = use_processes
                 with st.spinner("Parsing book structure..."):
                     success, msg = st.session_state.processor.parse_structure(uploaded_file.getvalue())
                     if success:
@@ -1171,13 +1687,9 @@ def main():
         with st.expander("Header & Footer Content", expanded=False):
             def elem_row(label, key_pos, key_ord, def_pos, def_ord):
                 c1, c2 = st.columns([2, 1])
-                opts = ["Header", "Footer", "Hidden"]
                 curr_pos = get_state(key_pos, def_pos)
-                try:
-                    def_idx = opts.index(curr_pos)
-                except:
-                    def_idx = 2
-                pos = c1.selectbox(label, opts, index=def_idx, key=key_pos)
+                def_idx = ELEMENT_POSITION_INDEX.get(curr_pos, 2)
+                pos = c1.selectbox(label, ELEMENT_POSITIONS, index=def_idx, key=key_pos)
                 ord_val = c2.number_input("Order", value=get_state(key_ord, def_ord), key=key_ord)
                 return pos, ord_val
 
@@ -1193,14 +1705,10 @@ def main():
                                                                                       "ord_perc", "Hidden", 4)
             st.divider()
             st.markdown("#### Progress Bar Configuration")
-            prog_opts = ["Footer (Below Text)", "Footer (Above Text)", "Header (Below Text)", "Header (Above Text)",
-                         "Hidden"]
             prog_curr = get_state("pos_progress", "Footer (Below Text)")
-            try:
-                prog_idx = prog_opts.index(prog_curr)
-            except:
-                prog_idx = 0
-            current_config['pos_progress'] = st.selectbox("Position", prog_opts, index=prog_idx, key="pos_progress")
+            prog_idx = PROGRESS_POSITION_INDEX.get(prog_curr, 0)
+            current_config['pos_progress'] = st.selectbox("Position", PROGRESS_POSITIONS, index=prog_idx,
+                                                          key="pos_progress")
             st.caption("Dimensions")
             p1, p2 = st.columns(2)
             current_config['bar_height'] = p1.number_input("Bar Thickness", 1, 10, get_state("bar_height", 4),
@@ -1231,10 +1739,9 @@ def main():
             h1, h2 = st.columns(2)
             current_config['header_font_size'] = h1.number_input("Font Size", 8, 30, get_state("header_font_size", 16),
                                                                  key="header_font_size")
-            align_opts = ["Center", "Left", "Right", "Justify"]
             h_align_curr = get_state("header_align", "Center")
-            h_idx = align_opts.index(h_align_curr) if h_align_curr in align_opts else 0
-            current_config['header_align'] = h2.selectbox("Alignment", align_opts, index=h_idx, key="header_align")
+            h_idx = ALIGN_INDEX.get(h_align_curr, 0)
+            current_config['header_align'] = h2.selectbox("Alignment", ALIGN_OPTIONS, index=h_idx, key="header_align")
             current_config['header_margin'] = st.number_input("Header Y-Offset", 0, 100, get_state("header_margin", 10),
                                                               key="header_margin")
             st.divider()
@@ -1243,8 +1750,8 @@ def main():
             current_config['footer_font_size'] = f1.number_input("Font Size ", 8, 30, get_state("footer_font_size", 16),
                                                                  key="footer_font_size")
             f_align_curr = get_state("footer_align", "Center")
-            f_idx = align_opts.index(f_align_curr) if f_align_curr in align_opts else 0
-            current_config['footer_align'] = f2.selectbox("Alignment ", align_opts, index=f_idx, key="footer_align")
+            f_idx = ALIGN_INDEX.get(f_align_curr, 0)
+            current_config['footer_align'] = f2.selectbox("Alignment ", ALIGN_OPTIONS, index=f_idx, key="footer_align")
             current_config['footer_margin'] = st.number_input("Footer Y-Offset", 0, 100, get_state("footer_margin", 10),
                                                               key="footer_margin")
 
@@ -1255,21 +1762,14 @@ def main():
 
     # --- MAIN RENDER LOGIC ---
     if font_mode == "Custom (Upload)" and uploaded_font_zip:
-        font_temp_dir = os.path.join(tempfile.gettempdir(), "epub_xtc_fonts")
-        if os.path.exists(font_temp_dir):
-            try:
-                shutil.rmtree(font_temp_dir)
-            except:
-                pass
-        os.makedirs(font_temp_dir, exist_ok=True)
+        font_zip_bytes = uploaded_font_zip.getvalue()
+        font_sig = hashlib.blake2b(font_zip_bytes, digest_size=8).hexdigest()
         try:
-            with zipfile.ZipFile(uploaded_font_zip) as z:
-                z.extractall(font_temp_dir)
-            scanned_fonts = get_font_variants(font_temp_dir)
+            _, scanned_fonts = _load_custom_font(font_sig, font_zip_bytes)
             if scanned_fonts.get("regular"):
                 final_font_data = scanned_fonts
                 current_config['font_source'] = "custom"
-                current_config['font_sig'] = uploaded_font_zip.name
+                current_config['font_sig'] = font_sig
                 st.success(f"Font loaded! Variants found: {[k for k, v in scanned_fonts.items() if v]}")
             else:
                 st.warning("No font files found in ZIP.")
@@ -1278,7 +1778,8 @@ def main():
 
     if final_font_data is None: final_font_data = "Times-Roman"
 
-    current_config['selected_indices_tuple'] = tuple(sorted(st.session_state.selected_chapter_indices))
+    # Both writers of selected_chapter_indices build it in ascending chapter order, so no sort is needed
+    current_config['selected_indices_tuple'] = tuple(st.session_state.selected_chapter_indices)
     should_render = (st.session_state.processor.is_parsed and (
             current_config != st.session_state.last_config or not st.session_state.processor.is_ready or st.session_state.get(
         'force_render', False)))
@@ -1308,42 +1809,28 @@ def main():
             if success:
                 st.session_state.last_config = current_config
                 new_total = st.session_state.processor.total_pages
-                st.session_state.current_page = int(relative_pos * new_total)
-                st.session_state.current_page = min(max(0, st.session_state.current_page), new_total - 1)
+                st.session_state.current_page = clamp(int(relative_pos * new_total), 0, new_total - 1)
                 st.rerun()
 
     if st.session_state.processor.is_ready:
+        total_pages = st.session_state.processor.total_pages
         c1, c2, c3 = st.columns([1, 2, 1])
         with c1:
             if st.button("⬅ Previous", use_container_width=True):
-                st.session_state.current_page = max(0, st.session_state.current_page - 1)
+                st.session_state.current_page = clamp(st.session_state.current_page - 1, 0, total_pages - 1)
         with c2:
             st.markdown(f"""<div style="text-align:center; padding-top: 5px; font-size:1.1rem; color: #444;">
-                    Page <b>{st.session_state.current_page + 1}</b> / {st.session_state.processor.total_pages}
+                    Page <b>{st.session_state.current_page + 1}</b> / {total_pages}
                 </div>""", unsafe_allow_html=True)
         with c3:
             if st.button("Next ➡", use_container_width=True):
-                st.session_state.current_page = min(st.session_state.processor.total_pages - 1,
-                                                    st.session_state.current_page + 1)
+                st.session_state.current_page = clamp(st.session_state.current_page + 1, 0, total_pages - 1)
 
-        img = st.session_state.processor.render_page(st.session_state.current_page)
         preview_width_val = st.session_state.get("preview_zoom_slider", 350)
-        base_size = int(preview_width_val)
-        if img.width > img.height:
-            target_h = base_size
-            target_w = int(target_h * (img.width / img.height))
-        else:
-            target_w = base_size
-            target_h = int(target_w * (img.height / img.width))
-
-        preview_img = img.copy().resize((target_w, target_h), Image.Resampling.LANCZOS)
-        with io.BytesIO() as buffer:
-            preview_img.save(buffer, format="PNG")
-            img_b64 = base64.b64encode(buffer.getvalue()).decode()
-
-        st.markdown(f"""<div style="display: flex; justify-content: center; margin-top: 15px;">
-                <img src="data:image/png;base64,{img_b64}" width="{target_w}" style="max-width: 100%; box-shadow: 0px 4px 15px rgba(0,0,0,0.15);">
-            </div>""", unsafe_allow_html=True)
+        preview_png, target_w = st.session_state.processor.get_preview_png(st.session_state.current_page,
+                                                                           int(preview_width_val))
+        # Full-width container: st.image caps its width at the parent, so a column would cut the zoom range short
+        st.container(horizontal_alignment="center").image(preview_png, width=target_w)
 
         st.columns([1, 2, 1])[1].slider("Preview Zoom", 200, 800, 350, key="preview_zoom_slider")
 
@@ -1354,7 +1841,7 @@ def main():
                 if 0 < val <= st.session_state.processor.total_pages:
                     st.session_state.current_page = val - 1
 
-            st.number_input("Jump to page:", min_value=1, max_value=st.session_state.processor.total_pages,
+            st.number_input("Jump to page:", min_value=1, max_value=total_pages,
                             value=st.session_state.current_page + 1, key="goto_input", on_change=update_page)
     else:
         st.info("👈 Please upload an EPUB file in the sidebar to begin.")